@@ -88,6 +88,7 @@ def default_params():
         warmup_steps=4000,
         train_steps=100000,
         update_cycle=1,
+        allow_tf32=False,
         optimizer="Adam",
         adam_beta1=0.9,
         adam_beta2=0.999,
@@ -259,6 +260,36 @@ def save_checkpoint(step, epoch, model, optimizer, params):
         utils.save(state, params.output, params.keep_checkpoint_max)
 
 
+def convert_optimizer_state(state):
+    # Merge the slots of separate q/k/v projections saved by older
+    # versions, mirroring MultiHeadAttention._load_from_state_dict
+    if "optimizer" in state:
+        state["optimizer"] = convert_optimizer_state(state["optimizer"])
+
+    slots = state.get("slot", {})
+
+    for key in list(slots):
+        m = re.match(r"(.*)q_transform\.(weight|bias)$", key)
+
+        if not m:
+            continue
+
+        prefix, suffix = m.groups()
+        keys = [prefix + name + "." + suffix
+                for name in ["q_transform", "k_transform", "v_transform"]]
+
+        if not all(k in slots for k in keys):
+            continue
+
+        merged = [slots.pop(k) for k in keys]
+        slots[prefix + "qkv_transform." + suffix] = {
+            "m": torch.cat([slot["m"] for slot in merged], dim=0),
+            "v": torch.cat([slot["v"] for slot in merged], dim=0)
+        }
+
+    return state
+
+
 def infer_gpu_num(param_str):
     result = re.match(r".*device_list=\[(.*?)\].*", param_str)
 
@@ -354,6 +385,13 @@ def main(args):
         export_params(params.output, "%s.json" % params.model,
                       collect_params(params, model_cls.default_params()))
 
+    if params.allow_tf32:
+        if not hasattr(torch, "set_float32_matmul_precision"):
+            raise ValueError("allow_tf32=true requires PyTorch >= 1.12")
+
+        # Allow TF32 tensor cores for float32 matrix multiplications
+        torch.set_float32_matmul_precision("high")
+
     model = model_cls(params).cuda()
 
     if args.half:
@@ -424,7 +462,8 @@ def main(args):
         model.load_state_dict(state["model"])
 
         if "optimizer" in state:
-            optimizer.load_state_dict(state["optimizer"])
+            optimizer.load_state_dict(
+                convert_optimizer_state(state["optimizer"]))
     else:
         step = 0
         epoch = 0
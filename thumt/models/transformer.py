@@ -8,6 +8,7 @@ from __future__ import print_function
 import math
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 
 import thumt.utils as utils
 import thumt.modules as modules
@@ -15,7 +16,7 @@ import thumt.modules as modules
 
 class AttentionSubLayer(modules.Module):
 
-    def __init__(self, params, name="attention"):
+    def __init__(self, params, num_kv_heads=None, name="attention"):
         super(AttentionSubLayer, self).__init__(name=name)
 
         self.dropout = params.residual_dropout
@@ -23,21 +24,28 @@ class AttentionSubLayer(modules.Module):
 
         with utils.scope(name):
             self.attention = modules.MultiHeadAttention(
-                params.hidden_size, params.num_heads, params.attention_dropout)
+                params.hidden_size, params.num_heads, params.attention_dropout,
+                num_kv_heads=num_kv_heads)
             self.layer_norm = modules.LayerNorm(params.hidden_size)
 
-    def forward(self, x, bias, memory=None, state=None):
+    def forward(self, x, bias, memory=None, state=None, offset=0,
+                causal=False):
         if self.normalization == "before":
             y = self.layer_norm(x)
         else:
             y = x
 
-        if self.training or state is None:
-            y = self.attention(y, bias, memory, None)
+        if state is None:
+            y = self.attention(y, bias, memory, None, causal=causal)
         else:
-            kv = [state["k"], state["v"]]
-            y, k, v = self.attention(y, bias, memory, kv)
-            state["k"], state["v"] = k, v
+            if "k_scale" in state:
+                names = ["k", "v", "k_scale", "v_scale"]
+            else:
+                names = ["k", "v"]
+
+            kv = [state[name] for name in names]
+            y, kv = self.attention(y, bias, memory, kv, offset)
+            state.update(zip(names, kv))
 
         y = nn.functional.dropout(y, self.dropout, self.training)
 
@@ -97,15 +105,30 @@ class TransformerDecoderLayer(modules.Module):
         super(TransformerDecoderLayer, self).__init__(name=name)
 
         with utils.scope(name):
-            self.self_attention = AttentionSubLayer(params,
-                                                    name="self_attention")
+            self.self_attention = AttentionSubLayer(
+                params, num_kv_heads=params.num_kv_heads,
+                name="self_attention")
             self.encdec_attention = AttentionSubLayer(params,
                                                     name="encdec_attention")
             self.feed_forward = FFNSubLayer(params)
 
-    def __call__(self, x, attn_bias, encdec_bias, memory, state=None):
-        x = self.self_attention(x, attn_bias, state=state)
-        x = self.encdec_attention(x, encdec_bias, memory)
+    def __call__(self, x, attn_bias, encdec_bias, memory, state=None,
+                 offset=None):
+        self_state, encdec_state = None, None
+
+        if state is not None:
+            encdec_state = state["encdec_attention"]
+
+            # Only incremental decoding reads and writes the cache
+            if offset is not None:
+                self_state = state["self_attention"]
+
+        # Without the cache, queries and keys span the same positions and
+        # the causal mask can be applied by the attention kernel itself
+        x = self.self_attention(x, attn_bias, state=self_state, offset=offset,
+                                causal=offset is None)
+        x = self.encdec_attention(x, encdec_bias, memory, state=encdec_state)
+
         x = self.feed_forward(x)
         return x
 
@@ -153,11 +176,12 @@ class TransformerDecoder(modules.Module):
             else:
                 self.layer_norm = None
 
-    def forward(self, x, attn_bias, encdec_bias, memory, state=None):
+    def forward(self, x, attn_bias, encdec_bias, memory, state=None,
+                offset=None):
         for i, layer in enumerate(self.layers):
             if state is not None:
                 x = layer(x, attn_bias, encdec_bias, memory,
-                          state["decoder"]["layer_%d" % i])
+                          state["decoder"][i], offset)
             else:
                 x = layer(x, attn_bias, encdec_bias, memory, None)
 
@@ -166,6 +190,18 @@ class TransformerDecoder(modules.Module):
 
         return x
 
+    def compute_cache(self, memory, state):
+        # The encoder output is fixed during decoding, project it to
+        # keys and values once instead of at every step
+        for i, layer in enumerate(self.layers):
+            k, v = layer.encdec_attention.attention.compute_cache(memory)
+            state["decoder"][i]["encdec_attention"] = {
+                "k": k,
+                "v": v
+            }
+
+        return state
+
 
 class Transformer(modules.Module):
 
@@ -185,8 +221,22 @@ class Transformer(modules.Module):
         self.hidden_size = params.hidden_size
         self.num_encoder_layers = params.num_encoder_layers
         self.num_decoder_layers = params.num_decoder_layers
+        self.kv_size = (params.hidden_size // params.num_heads
+                        * (params.num_kv_heads or params.num_heads))
+        self._causal_bias_cache = None
         self.reset_parameters()
 
+        if params.compile:
+            if not hasattr(nn.Module, "compile"):
+                raise ValueError("compile=true requires PyTorch >= 2.2")
+
+            # Compiled in place so that parameter names are unchanged
+            self.encoder.compile(dynamic=True)
+            self.decoder.compile(dynamic=True)
+
+        if params.autocast and not hasattr(torch, "autocast"):
+            raise ValueError("autocast=true requires PyTorch >= 1.10")
+
     def build_embedding(self, params):
         svoc_size = len(params.vocabulary["source"])
         tvoc_size = len(params.vocabulary["target"])
@@ -248,63 +298,114 @@ class Transformer(modules.Module):
     def encode(self, features, state):
         src_seq = features["source"]
         src_mask = features["source_mask"]
-        enc_attn_bias = self.masking_bias(src_mask)
 
         inputs = torch.nn.functional.embedding(src_seq, self.src_embedding)
-        inputs = inputs * (self.hidden_size ** 0.5)
-        inputs = inputs + self.bias
-        inputs = nn.functional.dropout(self.encoding(inputs), self.dropout,
-                                       self.training)
-
-        enc_attn_bias = enc_attn_bias.to(inputs)
+        signal = self.encoding.get_signal(inputs.shape[1], self.hidden_size,
+                                          inputs.dtype, inputs.device)
+        # Scale, bias and positional encoding in one pass over the inputs
+        inputs = torch.add(self.bias + signal, inputs,
+                           alpha=self.hidden_size ** 0.5)
+        inputs = nn.functional.dropout(inputs, self.dropout, self.training)
+
+        enc_attn_bias = self.masking_bias(src_mask, dtype=inputs.dtype)
         encoder_output = self.encoder(inputs, enc_attn_bias)
 
         state["encoder_output"] = encoder_output
         state["enc_attn_bias"] = enc_attn_bias
+        state = self.decoder.compute_cache(encoder_output, state)
 
         return state
 
     def decode(self, features, state, mode="infer"):
+        decoder_output = self.decode_hidden(features, state, mode)
+        decoder_output = torch.reshape(decoder_output, [-1, self.hidden_size])
+        logits = nn.functional.linear(decoder_output, self.softmax_embedding)
+
+        return logits, state
+
+    def decode_hidden(self, features, state, mode="infer"):
         tgt_seq = features["target"]
 
         enc_attn_bias = state["enc_attn_bias"]
-        dec_attn_bias = self.causal_bias(tgt_seq.shape[1])
 
         targets = torch.nn.functional.embedding(tgt_seq, self.tgt_embedding)
-        targets = targets * (self.hidden_size ** 0.5)
 
-        decoder_input = torch.cat(
-            [targets.new_zeros([targets.shape[0], 1, targets.shape[-1]]),
-             targets[:, 1:, :]], dim=1)
-        decoder_input = nn.functional.dropout(self.encoding(decoder_input),
-                                              self.dropout, self.training)
+        # The first position (<bos>) enters the decoder as zeros, the
+        # lookup result is a fresh tensor so it is cleared in place
+        decoder_input = targets
+        decoder_input[:, 0].zero_()
+        signal = self.encoding.get_signal(targets.shape[1], self.hidden_size,
+                                          targets.dtype, targets.device)
+        decoder_input = torch.add(signal, decoder_input,
+                                  alpha=self.hidden_size ** 0.5)
+        decoder_input = nn.functional.dropout(decoder_input, self.dropout,
+                                              self.training)
 
         encoder_output = state["encoder_output"]
-        dec_attn_bias = dec_attn_bias.to(targets)
+        dec_attn_bias = self.cached_causal_bias(tgt_seq.shape[1], targets)
 
         if mode == "infer":
             decoder_input = decoder_input[:, -1:, :]
             dec_attn_bias = dec_attn_bias[:, :, -1:, :]
+            # Position of the new decoder input in the key/value cache
+            offset = tgt_seq.shape[1] - 1
+        else:
+            # The whole target is given, attend over fresh keys and values
+            offset = None
 
         decoder_output = self.decoder(decoder_input, dec_attn_bias,
-                                      enc_attn_bias, encoder_output, state)
+                                      enc_attn_bias, encoder_output, state,
+                                      offset)
+
+        return decoder_output
 
+    def chunked_logits_loss(self, decoder_output, labels, chunk_size):
+        # Only chunk_size rows of the [batch * length, vocab] logits are
+        # alive at a time, the logits are recomputed in the backward pass
         decoder_output = torch.reshape(decoder_output, [-1, self.hidden_size])
-        decoder_output = torch.transpose(decoder_output, -1, -2)
-        logits = torch.matmul(self.softmax_embedding, decoder_output)
-        logits = torch.transpose(logits, 0, 1)
+        flat_labels = torch.reshape(labels, [-1])
+        losses = []
 
-        return logits, state
+        def logits_loss(x, y):
+            logits = nn.functional.linear(x, self.softmax_embedding)
+            return self.criterion(logits, y)
+
+        for i in range(0, flat_labels.shape[0], chunk_size):
+            x = decoder_output[i:i + chunk_size]
+            y = flat_labels[i:i + chunk_size]
+            losses.append(torch.utils.checkpoint.checkpoint(
+                logits_loss, x, y, use_reentrant=False))
+
+        return torch.reshape(torch.cat(losses), labels.shape)
 
     def forward(self, features, labels, mode="train", level="sentence"):
+        if self.params.autocast:
+            # Matrix multiplications run in bfloat16. The returned loss
+            # is cast back since CPU autocast does not keep it in float32
+            with torch.autocast(labels.device.type, dtype=torch.bfloat16):
+                loss = self.compute_loss(features, labels, mode, level)
+
+            return loss.float()
+
+        return self.compute_loss(features, labels, mode, level)
+
+    def compute_loss(self, features, labels, mode="train", level="sentence"):
         mask = features["target_mask"]
+        chunk_size = self.params.softmax_chunk_size
 
         state = self.empty_state(features["target"].shape[0],
                                  labels.device)
         state = self.encode(features, state)
-        logits, _ = self.decode(features, state, mode=mode)
-        loss = self.criterion(logits, labels)
-        mask = mask.to(logits)
+
+        if mode == "train" and chunk_size > 0:
+            decoder_output = self.decode_hidden(features, state, mode=mode)
+            loss = self.chunked_logits_loss(decoder_output, labels,
+                                            chunk_size)
+        else:
+            logits, _ = self.decode(features, state, mode=mode)
+            loss = self.criterion(logits, labels)
+
+        mask = mask.to(loss)
 
         if mode == "eval":
             if level == "sentence":
@@ -314,29 +415,60 @@ class Transformer(modules.Module):
 
         return torch.sum(loss * mask) / torch.sum(mask)
 
-    def empty_state(self, batch_size, device):
+    def empty_state(self, batch_size, device, max_length=0):
+        # One contiguous allocation for the keys and values of all layers
+        shape = [self.num_decoder_layers, 2, batch_size, max_length]
+
+        if self.params.quantize_kv_cache:
+            kv = torch.zeros(shape + [self.kv_size], dtype=torch.int8,
+                             device=device)
+            scale = torch.zeros(shape, device=device)
+        else:
+            kv = torch.zeros(shape + [self.kv_size], device=device)
+            scale = None
+
         state = {
-            "decoder": {
-                "layer_%d" % i: {
-                    "k": torch.zeros([batch_size, 0, self.hidden_size],
-                                     device=device),
-                    "v": torch.zeros([batch_size, 0, self.hidden_size],
-                                     device=device)
+            "decoder": [
+                {
+                    "self_attention": {
+                        "k": kv[i, 0],
+                        "v": kv[i, 1]
+                    }
                 } for i in range(self.num_decoder_layers)
-            }
+            ]
         }
 
+        if scale is not None:
+            for i, layer_state in enumerate(state["decoder"]):
+                layer_state["self_attention"]["k_scale"] = scale[i, 0]
+                layer_state["self_attention"]["v_scale"] = scale[i, 1]
+
         return state
 
+    def cached_causal_bias(self, length, like):
+        # The mask is grown geometrically and sliced, so incremental
+        # decoding does not rebuild an [length, length] tensor every step
+        bias = self._causal_bias_cache
+
+        if (bias is None or bias.shape[-1] < length
+                or bias.dtype != like.dtype or bias.device != like.device):
+            size = length if bias is None else max(length, 2 * bias.shape[-1])
+            bias = self.causal_bias(size, dtype=like.dtype,
+                                    device=like.device)
+            self._causal_bias_cache = bias
+
+        return bias[:, :, :length, :length]
+
     @staticmethod
-    def masking_bias(mask, inf=-1e9):
-        ret = (1.0 - mask) * inf
+    def masking_bias(mask, inf=-1e9, dtype=None):
+        # Built from the mask on its own device, no host-side tensor
+        ret = (1.0 - mask.to(dtype or mask.dtype)) * inf
         return torch.unsqueeze(torch.unsqueeze(ret, 1), 1)
 
     @staticmethod
-    def causal_bias(length, inf=-1e9):
-        ret = torch.ones([length, length]) * inf
-        ret = torch.triu(ret, diagonal=1)
+    def causal_bias(length, inf=-1e9, dtype=None, device=None):
+        ret = torch.full([length, length], inf, dtype=dtype, device=device)
+        ret.triu_(diagonal=1)
         return torch.reshape(ret, [1, 1, length, length])
 
     @staticmethod
@@ -349,6 +481,8 @@ class Transformer(modules.Module):
             hidden_size=512,
             filter_size=2048,
             num_heads=8,
+            # Key/value heads of decoder self-attention, 0 means num_heads
+            num_kv_heads=0,
             num_encoder_layers=6,
             num_decoder_layers=6,
             attention_dropout=0.0,
@@ -358,6 +492,10 @@ class Transformer(modules.Module):
             normalization="after",
             shared_embedding_and_softmax_weights=False,
             shared_source_target_embedding=False,
+            compile=False,
+            softmax_chunk_size=0,
+            autocast=False,
+            quantize_kv_cache=False,
             # Override default parameters
             warmup_steps=4000,
             train_steps=100000,
@@ -109,50 +109,138 @@ class MultiHeadAttentionBase(Module):
 class MultiHeadAttention(MultiHeadAttentionBase):
 
     def __init__(self, hidden_size, num_heads, dropout=0.0,
-                 name="multihead_attention"):
+                 num_kv_heads=None, name="multihead_attention"):
         super(MultiHeadAttention, self).__init__(name=name)
 
+        num_kv_heads = num_kv_heads or num_heads
+
+        if num_heads % num_kv_heads != 0:
+            raise ValueError("num_heads must be a multiple of num_kv_heads")
+
         self.num_heads = num_heads
+        self.num_kv_heads = num_kv_heads
         self.hidden_size = hidden_size
+        self.kv_size = hidden_size // num_heads * num_kv_heads
         self.dropout = dropout
 
         with utils.scope(name):
-            self.q_transform = Affine(hidden_size, hidden_size,
-                                      name="q_transform")
-            self.k_transform = Affine(hidden_size, hidden_size,
-                                      name="k_transform")
-            self.v_transform = Affine(hidden_size, hidden_size,
-                                      name="v_transform")
+            # Query, key and value projections share one weight matrix
+            self.qkv_transform = Affine(hidden_size,
+                                        hidden_size + 2 * self.kv_size,
+                                        name="qkv_transform")
             self.o_transform = Affine(hidden_size, hidden_size,
                                       name="o_transform")
 
         self.reset_parameters()
 
-    def forward(self, query, bias, memory=None, kv=None):
-        q = self.q_transform(query)
+    def compute_cache(self, memory):
+        n = self.hidden_size
+        weight = self.qkv_transform.weight[n:]
+        bias = self.qkv_transform.bias[n:]
+        kv = nn.functional.linear(memory, weight, bias)
+
+        return torch.split(kv, self.kv_size, dim=-1)
+
+    def forward(self, query, bias, memory=None, kv=None, offset=0,
+                causal=False):
+        n = self.hidden_size
 
         if memory is not None:
+            # encoder-decoder attention
+            q = nn.functional.linear(query, self.qkv_transform.weight[:n],
+                                     self.qkv_transform.bias[:n])
+
             if kv is not None:
                 k, v = kv
             else:
-                k, v = None, None
-
-            # encoder-decoder attention
-            k = k or self.k_transform(memory)
-            v = v or self.v_transform(memory)
+                k, v = self.compute_cache(memory)
         else:
             # self-attention
-            k = self.k_transform(query)
-            v = self.v_transform(query)
+            q, k, v = torch.split(self.qkv_transform(query),
+                                  [n, self.kv_size, self.kv_size], dim=-1)
 
             if kv is not None:
-                k = torch.cat([kv[0], k], dim=1)
-                v = torch.cat([kv[1], v], dim=1)
+                kv = self.write_cache(kv, k, v, offset)
+                k, v = self.read_cache(kv, offset + k.shape[1], q.dtype)
 
         # split heads
         qh = self.split_heads(q, self.num_heads)
-        kh = self.split_heads(k, self.num_heads)
-        vh = self.split_heads(v, self.num_heads)
+        kh = self.split_heads(k, self.num_kv_heads)
+        vh = self.split_heads(v, self.num_kv_heads)
+
+        if self.num_kv_heads != self.num_heads:
+            # Each group of query heads shares one key/value head
+            groups = self.num_heads // self.num_kv_heads
+            kh = torch.repeat_interleave(kh, groups, dim=1)
+            vh = torch.repeat_interleave(vh, groups, dim=1)
+
+        x = self.dot_product_attention(qh, kh, vh, bias, causal)
+
+        # combine heads
+        output = self.o_transform(self.combine_heads(x))
+
+        if kv is not None:
+            return output, kv
+
+        return output
+
+    @staticmethod
+    def quantize(x):
+        # Symmetric int8 quantization with one scale per position
+        scale = x.abs().amax(-1, keepdim=True).clamp(min=1e-5) / 127.0
+        x = torch.round(x / scale).to(torch.int8)
+        return x, torch.squeeze(scale, -1)
+
+    @staticmethod
+    def write_cache(kv, k, v, offset):
+        # kv: preallocated [batch, max_length, kv_size] key and value
+        # buffers, optionally int8 followed by [batch, max_length] scales.
+        # The new entries are written in place starting at offset
+        length = offset + k.shape[1]
+
+        if kv[0].shape[1] < length:
+            # Grow geometrically so that appends stay amortized O(1)
+            size = max(length, 2 * kv[0].shape[1])
+            kv = [nn.functional.pad(t, [0, 0] * (t.dim() - 2) +
+                                    [0, size - t.shape[1]]) for t in kv]
+
+        if len(kv) == 4:
+            k, k_scale = MultiHeadAttention.quantize(k)
+            v, v_scale = MultiHeadAttention.quantize(v)
+            values = [k, v, k_scale, v_scale]
+        else:
+            values = [k, v]
+
+        for buf, value in zip(kv, values):
+            buf[:, offset:length] = value
+
+        return kv
+
+    @staticmethod
+    def read_cache(kv, length, dtype):
+        k = kv[0][:, :length]
+        v = kv[1][:, :length]
+
+        if len(kv) == 4:
+            k = k.to(dtype) * kv[2][:, :length, None].to(dtype)
+            v = v.to(dtype) * kv[3][:, :length, None].to(dtype)
+
+        return k, v
+
+    def dot_product_attention(self, qh, kh, vh, bias, causal=False):
+        # bias must also be given when causal is True, it is used if the
+        # fused kernels are not available
+        dropout = self.dropout if self.training else 0.0
+
+        if hasattr(nn.functional, "scaled_dot_product_attention"):
+            if causal:
+                # No explicit mask, eligible for FlashAttention
+                return nn.functional.scaled_dot_product_attention(
+                    qh, kh, vh, dropout_p=dropout, is_causal=True)
+
+            # Float masks limit dispatch to memory-efficient/math kernels
+            return nn.functional.scaled_dot_product_attention(
+                qh, kh, vh, attn_mask=bias, dropout_p=dropout)
 
         # scale query
         qh = qh * (self.hidden_size // self.num_heads) ** -0.5
@@ -165,33 +253,38 @@ class MultiHeadAttention(MultiHeadAttentionBase):
             logits = logits + bias
 
         weights = torch.nn.functional.dropout(torch.softmax(logits, dim=-1),
-                                              p=self.dropout,
+                                              p=dropout,
                                               training=self.training)
 
-        x = torch.matmul(weights, vh)
-
-        # combine heads
-        output = self.o_transform(self.combine_heads(x))
-
-        if kv is not None:
-            return output, k, v
-
-        return output
+        return torch.matmul(weights, vh)
 
     def reset_parameters(self, initializer="uniform_scaling", **kwargs):
         if initializer == "uniform_scaling":
             # 6 / (4 * hidden_size) -> 6 / (2 * hidden_size)
-            nn.init.xavier_uniform_(self.q_transform.weight, 2 ** -0.5)
-            nn.init.xavier_uniform_(self.k_transform.weight, 2 ** -0.5)
-            nn.init.xavier_uniform_(self.v_transform.weight, 2 ** -0.5)
+            sizes = [self.hidden_size, self.kv_size, self.kv_size]
+
+            for weight in torch.split(self.qkv_transform.weight, sizes):
+                nn.init.xavier_uniform_(weight, 2 ** -0.5)
             nn.init.xavier_uniform_(self.o_transform.weight)
-            nn.init.constant_(self.q_transform.bias, 0.0)
-            nn.init.constant_(self.k_transform.bias, 0.0)
-            nn.init.constant_(self.v_transform.bias, 0.0)
+            nn.init.constant_(self.qkv_transform.bias, 0.0)
             nn.init.constant_(self.o_transform.bias, 0.0)
         else:
             raise ValueError("Unknown initializer %d" % initializer)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Merge separate q/k/v projections from older checkpoints
+        names = ["q_transform", "k_transform", "v_transform"]
+
+        for suffix in ["weight", "bias"]:
+            keys = [prefix + name + "." + suffix for name in names]
+
+            if all(key in state_dict for key in keys):
+                state_dict[prefix + "qkv_transform." + suffix] = torch.cat(
+                    [state_dict.pop(key) for key in keys], dim=0)
+
+        super(MultiHeadAttention, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+
 
 class MultiHeadAdditiveAttention(MultiHeadAttentionBase):
 
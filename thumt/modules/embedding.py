@@ -13,19 +13,14 @@ class PositionalEmbedding(torch.nn.Module):
 
     def __init__(self):
         super(PositionalEmbedding, self).__init__()
+        self._signal = None
 
-    def forward(self, inputs):
-        if inputs.dim() != 3:
-            raise ValueError("The rank of input must be 3.")
-
-        length = inputs.shape[1]
-        channels = inputs.shape[2]
+    @staticmethod
+    def build_signal(length, channels):
         half_dim = channels // 2
 
-        positions = torch.arange(length, dtype=inputs.dtype,
-                                 device=inputs.device)
-        dimensions = torch.arange(half_dim, dtype=inputs.dtype,
-                                  device=inputs.device)
+        positions = torch.arange(length, dtype=torch.float32)
+        dimensions = torch.arange(half_dim, dtype=torch.float32)
 
         scale = math.log(10000.0) / float(half_dim - 1)
         dimensions.mul_(-scale).exp_()
@@ -35,8 +30,32 @@ class PositionalEmbedding(torch.nn.Module):
                            dim=1)
 
         if channels % 2 == 1:
-            pad = torch.zeros([signal.shape[0], 1], dtype=inputs.dtype,
-                              device=inputs.device)
+            pad = torch.zeros([signal.shape[0], 1], dtype=torch.float32)
             signal = torch.cat([signal, pad], axis=1)
 
-        return inputs + torch.reshape(signal, [1, -1, channels]).to(inputs)
+        return torch.reshape(signal, [1, -1, channels])
+
+    def get_signal(self, length, channels, dtype, device):
+        # The sinusoid table is built once and sliced, it is only rebuilt
+        # for longer inputs or a different dtype/device
+        signal = self._signal
+
+        if (signal is None or signal.shape[1] < length
+                or signal.shape[2] != channels or signal.dtype != dtype
+                or signal.device != device):
+            size = length if signal is None else max(length,
+                                                     2 * signal.shape[1])
+            signal = self.build_signal(size, channels)
+            signal = signal.to(dtype=dtype, device=device)
+            self._signal = signal
+
+        return signal[:, :length]
+
+    def forward(self, inputs):
+        if inputs.dim() != 3:
+            raise ValueError("The rank of input must be 3.")
+
+        signal = self.get_signal(inputs.shape[1], inputs.shape[2],
+                                 inputs.dtype, inputs.device)
+
+        return inputs + signal
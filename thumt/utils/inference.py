@@ -43,6 +43,23 @@ def _gather_2d(params, indices, name=None):
     return output
 
 
+def _gather_state(state, indices, length):
+    if "decoder" not in state:
+        return map_structure(lambda x: _gather_2d(x, indices), state)
+
+    # Only the decoder self-attention caches depend on the beam. The
+    # encoder output and the encoder-decoder keys/values are the same for
+    # all beams of a sentence and are left untouched. The caches are
+    # preallocated to the maximum decoding length, reorder the filled
+    # prefix in place instead of copying the buffers
+    for layer_state in state["decoder"]:
+        for x in layer_state["self_attention"].values():
+            x = x[:, :, :length]
+            x.copy_(_gather_2d(x, indices))
+
+    return state
+
+
 class BeamSearchState(namedtuple("BeamSearchState",
                                  ("inputs", "state", "finish"))):
     pass
@@ -128,9 +145,8 @@ def _beam_search_step(time, func, state, batch_size, beam_size, alpha,
     alive_seqs = _gather_2d(seqs, alive_indices)
     # [batch_size, beam_size, time + 1]
     alive_seqs = torch.cat([alive_seqs, torch.unsqueeze(alive_symbols, 2)], 2)
-    alive_state = map_structure(
-        lambda x: _gather_2d(x, alive_indices),
-        next_state)
+    alive_state = [_gather_state(x, alive_indices, time + 1)
+                   for x in next_state]
     alive_log_probs = alive_scores * length_penalty
     # Check length constraint
     length_flags = torch.le(max_length, time + 1).float()
@@ -181,19 +197,20 @@ def beam_search(models, features, params):
     batch_size = shape[0]
     seq_length = shape[1]
 
+    # For source sequence length
+    max_length = features["source_mask"].sum(1) * decode_ratio
+    max_length = max_length.long() + decode_length
+    max_step = int(max_length.max())
+
     # Compute initial state if necessary
     states = []
     funcs = []
 
     for model in models:
-        state = model.empty_state(batch_size, device)
+        state = model.empty_state(batch_size, device, max_step)
         states.append(model.encode(features, state))
         funcs.append(model.decode)
 
-    # For source sequence length
-    max_length = features["source_mask"].sum(1) * decode_ratio
-    max_length = max_length.long() + decode_length
-    max_step = max_length.max()
     # [batch, beam_size]
     max_length = torch.unsqueeze(max_length, 1).repeat([1, beam_size])
     min_length = torch.ones_like(max_length)